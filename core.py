@@ -15,7 +15,7 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.	 If not, see <http://www.gnu.org/licenses/>.
 	
-import bpy, bpy.utils.previews, bmesh, glob, math, os, time
+import bpy, bpy.utils.previews, bmesh, collections, functools, math, numpy, os, time
 from . import import_md5mesh, lexer
 from mathutils import Vector
 
@@ -26,6 +26,8 @@ _scale_to_blender = 1.0 / _scale_to_game
 _editor_material_paths = ["textures/common", "textures/editor"]
 
 preview_collections = {}
+
+_file_systems = {}
 				
 ################################################################################
 ## FILE SYSTEM
@@ -39,58 +41,81 @@ class FileSystem:
 			self.search_dirs.append(bpy.context.scene.bfg.mod_dir)
 		self.search_dirs.append("basedev")
 		self.search_dirs.append("base")
+		self.game_path = os.path.realpath(bpy.path.abspath(bpy.context.scene.bfg.game_path))
+		self.search_paths = tuple(os.path.join(self.game_path, search_dir) for search_dir in self.search_dirs)
 		
 	def calculate_relative_path(self, filename):
 		# e.g. if game_path is "D:\Games\DOOM 3",
 		# "D:\Games\DOOM 3\basedev\models\mapobjects\arcade_machine\arcade_machine.lwo"
 		# should return
 		# "models\mapobjects\arcade_machine\arcade_machine.lwo"
-		for search_dir in self.search_dirs:
-			full_search_path = os.path.join(os.path.realpath(bpy.path.abspath(bpy.context.scene.bfg.game_path)), search_dir).lower()
-			full_file_path = os.path.realpath(bpy.path.abspath(filename)).lower()
-			if full_file_path.startswith(full_search_path):
-				return os.path.relpath(full_file_path, full_search_path)
+		full_file_path = os.path.realpath(bpy.path.abspath(filename)).lower()
+		for search_path in self.search_paths:
+			prefix = os.path.join(search_path, "").lower() # trailing separator, "base" shouldn't match "basedev"
+			if full_file_path.startswith(prefix):
+				return full_file_path[len(prefix):]
 		return None
 		
 	def find_file_path(self, filename):
-		for search_dir in self.search_dirs:
-			full_path = os.path.join(os.path.realpath(bpy.path.abspath(bpy.context.scene.bfg.game_path)), search_dir, filename)
-			if os.path.exists(full_path):
-				return full_path
-		return None
+		return find_file_path(self.search_paths, filename)
 		
-	def find_image_file_path(self, filename):
-		if filename == "_black":
-			filename = "textures/black"
-		elif filename == "_white":
-			filename = "guis/assets/white"
-		path = self.find_file_path(filename)
-		if not path:
-			# try some other extensions
-			name, extension = os.path.splitext(filename)
-			if extension != ".tga":
-				path = self.find_file_path(name + ".tga")
-			if not path and extension != ".png":
-				path = self.find_file_path(name + ".png")
-		return path
+	def find_image_file_path(self, filename, cached=True):
+		if cached:
+			return find_image_file_path(self.search_paths, filename)
+		return find_image_file_path.__wrapped__(self.search_paths, filename)
 		
-	def find_files(self, pattern):
+	def find_files(self, subdir, extension):
 		# don't touch the same file more than once
 		# e.g.
 		# mymod/materials/base_wall.mtr
 		# basedev/materials/base_wall.mtr
 		# ignore the second one
-		touched_files = []
+		touched_files = set()
 		found_files = []
 		for search_dir in self.search_dirs:
-			full_path = os.path.join(os.path.realpath(bpy.path.abspath(bpy.context.scene.bfg.game_path)), search_dir)
-			if os.path.exists(full_path):
-				for f in glob.glob(os.path.join(full_path, pattern)):
-					base = os.path.basename(f)
-					if not base in touched_files:
-						touched_files.append(base)
-						found_files.append(f)
+			full_path = os.path.join(self.game_path, search_dir, subdir)
+			if os.path.isdir(full_path):
+				# scandir entries carry the file type, so there's no stat per file
+				for entry in os.scandir(full_path):
+					if entry.name.lower().endswith(extension) and entry.is_file() and not entry.name in touched_files:
+						touched_files.add(entry.name)
+						found_files.append(entry.path)
 		return found_files
+		
+# FileSystem resolves paths when it's created, so share one per game path and mod directory
+def get_file_system():
+	bfg = bpy.context.scene.bfg
+	key = (bpy.path.abspath(bfg.game_path), bfg.mod_dir)
+	fs = _file_systems.get(key)
+	if not fs:
+		fs = _file_systems[key] = FileSystem()
+	return fs
+	
+def find_file_path(search_paths, filename):
+	for search_path in search_paths:
+		full_path = os.path.join(search_path, filename)
+		if os.path.exists(full_path):
+			return full_path
+	return None
+	
+# the material and light previews look up the same images on every refresh, so remember the results
+# call cache_clear when the files on disk may have changed, e.g. when importing or refreshing materials
+# creating materials doesn't use the cache, so they always get the image currently on disk
+@functools.lru_cache(maxsize=8192)
+def find_image_file_path(search_paths, filename):
+	if filename == "_black":
+		filename = "textures/black"
+	elif filename == "_white":
+		filename = "guis/assets/white"
+	path = find_file_path(search_paths, filename)
+	if not path:
+		# try some other extensions
+		name, extension = os.path.splitext(filename)
+		if extension != ".tga":
+			path = find_file_path(search_paths, name + ".tga")
+		if not path and extension != ".png":
+			path = find_file_path(search_paths, name + ".png")
+	return path
 						
 ################################################################################
 ## UTILITY FUNCTIONS
@@ -132,35 +157,62 @@ class MaterialDeclPropGroup(bpy.types.PropertyGroup):
 	specular_texture = bpy.props.StringProperty()
 	texture = bpy.props.StringProperty() # any stage texture map. will be the light texture for light materials.
 	
+# material decl indices grouped by decl path, and the indices of light material decls
+# built on first use, reset by ImportMaterials
+# material_decls belongs to the scene, so the index is rebuilt for another scene (or .blend) or if the number of decls changed
+def get_material_decl_index(scene):
+	pcoll = preview_collections["material"]
+	key = (scene.as_pointer(), len(scene.bfg.material_decls))
+	if pcoll.decl_index == None or pcoll.decl_index[0] != key:
+		decls_by_path = {}
+		light_decls = []
+		for i, decl in enumerate(scene.bfg.material_decls):
+			decl_path = os.path.dirname(decl.name)
+			decls_by_path.setdefault(decl_path, []).append(i)
+			if decl_path.startswith("lights"):
+				light_decls.append(i)
+		pcoll.decl_index = (key, decls_by_path, light_decls)
+	return pcoll.decl_index[1:]
+	
 def material_decl_preview_items(self, context):
 	materials = []
 	pcoll = preview_collections["material"]
 	if pcoll.current_decl_path == context.scene.bfg.active_material_decl_path and not pcoll.force_refresh:
 		return pcoll.materials
-	fs = FileSystem()
+	fs = get_file_system()
 	i = 0
-	for decl in context.scene.bfg.material_decls:
-		decl_path = os.path.dirname(decl.name)
-		if decl_path == context.scene.bfg.active_material_decl_path:
-			if context.scene.bfg.hide_bad_materials and decl_path not in _editor_material_paths and (decl.diffuse_texture == "" or not fs.find_image_file_path(decl.diffuse_texture)):
-				# hide materials with missing diffuse texture, but not editor materials
-				continue
-			if decl.editor_texture in pcoll: # workaround blender bug, pcoll.load is supposed to return cached preview if name already exists
-				preview = pcoll[decl.editor_texture]
-			else:
-				preview = None
-				if decl.editor_texture != "":
-					filename = fs.find_image_file_path(decl.editor_texture)
-					if filename:
-						preview = pcoll.load(decl.editor_texture, filename, 'IMAGE')
-			materials.append((decl.name, os.path.basename(decl.name), decl.name, preview.icon_id if preview else 0, i))
-			i += 1
+	decls = context.scene.bfg.material_decls
+	decl_path = context.scene.bfg.active_material_decl_path
+	decls_by_path = get_material_decl_index(context.scene)[0]
+	for decl_index in decls_by_path.get(decl_path, []):
+		decl = decls[decl_index]
+		if context.scene.bfg.hide_bad_materials and decl_path not in _editor_material_paths and (decl.diffuse_texture == "" or not fs.find_image_file_path(decl.diffuse_texture)):
+			# hide materials with missing diffuse texture, but not editor materials
+			continue
+		if decl.editor_texture in pcoll: # workaround blender bug, pcoll.load is supposed to return cached preview if name already exists
+			preview = pcoll[decl.editor_texture]
+		else:
+			preview = None
+			if decl.editor_texture != "":
+				filename = fs.find_image_file_path(decl.editor_texture)
+				if filename:
+					# this only registers the preview, the image is read later by blender's thumbnail job and cached on disk
+					# so there's nothing here to move off the ui thread - bpy can't be used from other threads anyway
+					preview = pcoll.load(decl.editor_texture, filename, 'IMAGE')
+		materials.append((decl.name, os.path.basename(decl.name), decl.name, preview.icon_id if preview else 0, i))
+		i += 1
 	materials.sort()
 	pcoll.materials = materials
 	pcoll.current_decl_path = context.scene.bfg.active_material_decl_path
 	pcoll.force_refresh = False
 	return pcoll.materials
 					
+class MaterialStage:
+	def __init__(self):
+		self.blend = None
+		self.heightmap_scale = 0
+		self.texture = None
+						
 class ImportMaterials(bpy.types.Operator):
 	bl_idname = "scene.import_materials"
 	bl_label = "Import Materials"
@@ -180,101 +232,133 @@ class ImportMaterials(bpy.types.Operator):
 		scale = float(lex.parse_token())
 		lex.expect_token(")")
 		return (texture, scale)
+		
+	def parse_stage_blend(self, stage, lex):
+		stage.blend = lex.parse_token()
+		
+	def parse_stage_map(self, stage, lex):
+		token = lex.parse_token()
+		map_type = token.lower()
+		if map_type == "addnormals":
+			stage.texture = self.parse_addnormals(stage, lex)
+		elif map_type == "heightmap":
+			(stage.texture, stage.heightmap_scale) = self.parse_heightmap(stage, lex)
+		else:
+			stage.texture = token
+			
+	def parse_bumpmap(self, decl, lex):
+		token = lex.parse_token()
+		map_type = token.lower()
+		if map_type == "addnormals":
+			decl.normal_texture = self.parse_addnormals(decl, lex)
+		elif map_type == "heightmap":
+			(decl.normal_texture, decl.heightmap_scale) = self.parse_heightmap(decl, lex)
+		else:
+			decl.normal_texture = token
+			
+	def parse_diffusemap(self, decl, lex):
+		decl.diffuse_texture = lex.parse_token()
+		
+	def parse_editorimage(self, decl, lex):
+		decl.editor_texture = lex.parse_token()
+		
+	def parse_specularmap(self, decl, lex):
+		decl.specular_texture = lex.parse_token()
+		
+	# lowercase keyword -> parse function
+	stage_keywords = {
+		"blend": parse_stage_blend,
+		"map": parse_stage_map
+	}
+	decl_keywords = {
+		"bumpmap": parse_bumpmap,
+		"diffusemap": parse_diffusemap,
+		"qer_editorimage": parse_editorimage,
+		"specularmap": parse_specularmap
+	}
 
-	def parse_material_file(self, filename):
-		lex = lexer.Lexer(filename)
+	def parse_material_file(self, filename, decl_indices):
+		"""decl_indices maps existing material decl names to their index in scene.bfg.material_decls"""
 		num_materials_created = 0
 		num_materials_updated = 0
 		scene = bpy.context.scene
+		stage_keywords = self.stage_keywords
+		decl_keywords = self.decl_keywords
 		print("Parsing", os.path.basename(filename), "...", end="", flush=True)
-		while True:
-			token = lex.parse_token()
-			if token == None:
-				break
-			if token in [ "particle", "skin", "table"]:
-				lex.parse_token() # name
-				lex.skip_bracket_delimiter_section("{", "}")
-			else:
-				if token == "material":
-					name = lex.parse_token()
-				else:
-					name = token
-				if name in scene.bfg.material_decls:
-					decl = scene.bfg.material_decls[name]
-					num_materials_updated += 1
+		with lexer.Lexer(filename) as lex:
+			parse_token = lex.parse_token
+			while True:
+				token = parse_token()
+				if token == None:
+					break
+				if token in [ "particle", "skin", "table"]:
+					parse_token() # name
+					lex.skip_bracket_delimiter_section("{", "}")
 				else:
-					num_materials_created += 1
-					decl = scene.bfg.material_decls.add()
-					decl.name = name
-				lex.expect_token("{")
-				num_required_closing = 1
-				in_stage = False
-				stage_blend = None
-				stage_heightmap_scale = 0
-				stage_texture = None 
-				while True:
-					token = lex.parse_token()
-					if token == None:
-						break
-					elif token == "{":
-						num_required_closing += 1
-						if num_required_closing == 2:
-							# 2nd opening brace: now in a stage
-							in_stage = True
-							stage_blend = None
-							stage_heightmap_scale = 0
-							stage_texture = None
-					elif token == "}":
-						num_required_closing -= 1
-						if num_required_closing == 0:
-							break
-						elif num_required_closing == 1:
-							# one closing brace left: closing stage
-							in_stage = False
-							if stage_texture:
-								decl.texture = stage_texture # any stage texture map. will be the light texture for light materials.
-							if stage_blend and stage_texture:
-								if stage_blend.lower() == "bumpmap":
-									decl.normal_texture = stage_texture
-									decl.heightmap_scale = stage_heightmap_scale
-								elif stage_blend.lower() == "diffusemap":
-									decl.diffuse_texture = stage_texture
-								elif stage_blend.lower() == "specularmap":
-									decl.specular_texture = stage_texture
-					if in_stage:
-						if token.lower() == "blend":
-							stage_blend = lex.parse_token()
-						elif token.lower() == "map":
-							token = lex.parse_token()
-							if token.lower() == "addnormals":
-								stage_texture = self.parse_addnormals(decl, lex)
-							elif token.lower() == "heightmap":
-								(stage_texture, stage_heightmap_scale) = self.parse_heightmap(decl, lex)
-							else:
-								stage_texture = token
+					if token == "material":
+						name = parse_token()
 					else:
-						if token.lower() == "bumpmap":
-							token = lex.parse_token()
-							if token.lower() == "addnormals":
-								decl.normal_texture = self.parse_addnormals(decl, lex)
-							elif token.lower() == "heightmap":
-								(decl.normal_texture, decl.heightmap_scale) = self.parse_heightmap(decl, lex)
-							else:
-								decl.normal_texture = token
-						elif token.lower() == "diffusemap":
-							decl.diffuse_texture = lex.parse_token()
-						elif token.lower() == "qer_editorimage":
-							decl.editor_texture = lex.parse_token()
-						elif token.lower() == "specularmap":
-							decl.specular_texture = lex.parse_token()
+						name = token
+					# index instead of name lookup, the collection is searched linearly by name
+					index = decl_indices.get(name)
+					if index is not None:
+						decl = scene.bfg.material_decls[index]
+						num_materials_updated += 1
+					else:
+						num_materials_created += 1
+						decl_indices[name] = len(scene.bfg.material_decls)
+						decl = scene.bfg.material_decls.add()
+						decl.name = name
+					lex.expect_token("{")
+					num_required_closing = 1
+					in_stage = False
+					stage = MaterialStage()
+					while True:
+						token = parse_token()
+						if token == None:
+							break
+						elif token == "{":
+							num_required_closing += 1
+							if num_required_closing == 2:
+								# 2nd opening brace: now in a stage
+								in_stage = True
+								stage = MaterialStage()
+						elif token == "}":
+							num_required_closing -= 1
+							if num_required_closing == 0:
+								break
+							elif num_required_closing == 1:
+								# one closing brace left: closing stage
+								in_stage = False
+								if stage.texture:
+									decl.texture = stage.texture # any stage texture map. will be the light texture for light materials.
+								if stage.blend and stage.texture:
+									blend = stage.blend.lower()
+									if blend == "bumpmap":
+										decl.normal_texture = stage.texture
+										decl.heightmap_scale = stage.heightmap_scale
+									elif blend == "diffusemap":
+										decl.diffuse_texture = stage.texture
+									elif blend == "specularmap":
+										decl.specular_texture = stage.texture
+						elif in_stage:
+							parse_keyword = stage_keywords.get(token.lower())
+							if parse_keyword:
+								parse_keyword(self, stage, lex)
+						else:
+							parse_keyword = decl_keywords.get(token.lower())
+							if parse_keyword:
+								parse_keyword(self, decl, lex)
 		print(" %d materials" % (num_materials_created + num_materials_updated))
 		return (num_materials_created, num_materials_updated)
 		
 	def update_material_decl_paths(self, scene):
 		scene.bfg.material_decl_paths.clear()
+		paths = set()
 		for decl in scene.bfg.material_decls:
 			name = os.path.dirname(decl.name)
-			if name.startswith("textures") and not name in scene.bfg.material_decl_paths:
+			if name.startswith("textures") and not name in paths:
+				paths.add(name)
 				path = scene.bfg.material_decl_paths.add()
 				path.name = name
 				
@@ -286,16 +370,19 @@ class ImportMaterials(bpy.types.Operator):
 		self.num_materials_created = 0
 		self.num_materials_updated = 0
 		start_time = time.time() 
-		fs = FileSystem()
-		files = fs.find_files(os.path.join("materials", "*.mtr"))
+		find_image_file_path.cache_clear()
+		fs = get_file_system()
+		files = fs.find_files("materials", ".mtr")
+		decl_indices = {decl.name: i for i, decl in enumerate(context.scene.bfg.material_decls)}
 		wm = context.window_manager
 		wm.progress_begin(0, len(files))
 		for i, f in enumerate(files):
-			result = self.parse_material_file(f)
+			result = self.parse_material_file(f, decl_indices)
 			wm.progress_update(i)
 			self.num_materials_created += result[0]
 			self.num_materials_updated += result[1]
 		self.update_material_decl_paths(context.scene)
+		preview_collections["material"].decl_index = None
 		preview_collections["light"].needs_refresh = True
 		wm.progress_end()
 		self.report({'INFO'}, "Imported %d materials, updated %d in %.2f seconds" % (self.num_materials_created, self.num_materials_updated, time.time() - start_time))
@@ -309,7 +396,7 @@ def create_material_texture(fs, mat, texture, slot_number):
 		tex = bpy.data.textures.new(texture, type='IMAGE')
 		
 	# texture image may have changed
-	img_filename = fs.find_image_file_path(texture)
+	img_filename = fs.find_image_file_path(texture, cached=False)
 	if img_filename:
 		# try to use relative paths for image filenames
 		try:
@@ -333,11 +420,10 @@ def create_material_texture(fs, mat, texture, slot_number):
 	return (tex, mat.texture_slots[slot_number])
 		
 def create_material(decl):
-	if decl.name in bpy.data.materials:
-		mat = bpy.data.materials[decl.name]
-	else:
+	mat = bpy.data.materials.get(decl.name)
+	if not mat:
 		mat = bpy.data.materials.new(decl.name)
-	fs = FileSystem()
+	fs = get_file_system()
 	decl_path = os.path.dirname(decl.name)
 	mat.preview_render_type = 'CUBE'
 	if decl_path in _editor_material_paths:
@@ -372,9 +458,9 @@ def create_material(decl):
 	return mat
 	
 def get_or_create_active_material(context):
-	bfg = context.scene.bfg
-	if bfg.active_material_decl in context.scene.bfg.material_decls:
-		return create_material(context.scene.bfg.material_decls[bfg.active_material_decl])
+	decl = context.scene.bfg.material_decls.get(context.scene.bfg.active_material_decl)
+	if decl:
+		return create_material(decl)
 	return None
 	
 def assign_material(obj, mat, where='ALL'):
@@ -389,19 +475,22 @@ def assign_material(obj, mat, where='ALL'):
 	else:
 		if len(obj.data.materials) == 1:
 			# one slot: easy, just reassign
-			obj.data.materials[0] = mat
+			if obj.data.materials[0] != mat:
+				obj.data.materials[0] = mat
 		else:
-			obj.data.materials.clear()
+			if len(obj.data.materials) > 0:
+				obj.data.materials.clear()
 			obj.data.materials.append(mat)
 			
-			# there was more than one material slot on this object
-			# need to set material_index on all faces to 0
-			bm = bmesh.new()
-			bm.from_mesh(obj.data)
-			for f in bm.faces:
-				f.material_index = 0
-			bm.to_mesh(obj.data)
-			bm.free()
+			# there was zero or more than one material slot on this object
+			# need to set material_index on all faces to 0, unless they already are
+			polygons = obj.data.polygons
+			indices = numpy.empty(len(polygons), dtype=numpy.int32)
+			polygons.foreach_get("material_index", indices)
+			if indices.any():
+				indices.fill(0)
+				polygons.foreach_set("material_index", indices)
+				obj.data.update()
 			
 class AssignMaterial(bpy.types.Operator):
 	"""Assign the material to the selected objects or object faces"""
@@ -437,23 +526,16 @@ class AssignMaterial(bpy.types.Operator):
 					
 				# remove any material slots that are now unused
 				# pop function update_data arg doesn't work, need to remap face material_index ourselves after removal
-				old_material_names = []
-				for m in obj.data.materials:
-					old_material_names.append(m.name)
-				remove_materials = []
-				for i, m in enumerate(obj.data.materials):
-					used = False
+				used_indices = {f.material_index for f in bm.faces}
+				num_slots = len(obj.data.materials)
+				keep = [i for i in range(num_slots) if i in used_indices]
+				if len(keep) < num_slots:
+					remap = {old: new for new, old in enumerate(keep)}
+					for i in reversed(range(num_slots)): # highest first so the remaining indices don't shift
+						if not i in used_indices:
+							obj.data.materials.pop(i, True)
 					for f in bm.faces:
-						if f.material_index == i:
-							used = True
-							break
-					if not used:
-						remove_materials.append(m)
-				if len(remove_materials) > 0:
-					for m in remove_materials:
-						obj.data.materials.pop(obj.data.materials.find(m.name), True)
-				for f in bm.faces:
-					f.material_index = obj.data.materials.find(old_material_names[f.material_index])
+						f.material_index = remap.get(f.material_index, 0)
 					
 				bmesh.update_edit_mesh(obj.data)
 			#bm.free() # bmesh.from_edit_mesh returns garbage after this is called
@@ -464,14 +546,18 @@ class AssignMaterial(bpy.types.Operator):
 		return {'FINISHED'}
 		
 def refresh_selected_objects_materials(context):
-	refreshed = [] # don't refresh the same material twice
+	refreshed = set() # don't refresh the same material twice
+	decls = None # name lookup, only built if there's something to refresh
 	for obj in context.selected_objects:
 		if hasattr(obj.data, "materials"):
 			for mat in obj.data.materials:
-				if mat not in refreshed and mat.name in context.scene.bfg.material_decls:
-					decl = context.scene.bfg.material_decls[mat.name]
-					create_material(decl)
-					refreshed.append(mat)
+				if mat and mat.name not in refreshed:
+					refreshed.add(mat.name)
+					if decls == None:
+						decls = {decl.name: decl for decl in context.scene.bfg.material_decls}
+					decl = decls.get(mat.name)
+					if decl:
+						create_material(decl)
 		
 class RefreshMaterials(bpy.types.Operator):
 	"""Refresh the select objects' materials, recreating them from their corresponding material decls"""
@@ -483,6 +569,7 @@ class RefreshMaterials(bpy.types.Operator):
 		return len(context.scene.bfg.material_decls) > 0
 	
 	def execute(self, context):
+		find_image_file_path.cache_clear()
 		refresh_selected_objects_materials(context)
 		return {'FINISHED'}
 		
@@ -593,6 +680,12 @@ class EntityDictPropGroup(bpy.types.PropertyGroup):
 class EntityPropGroup(bpy.types.PropertyGroup):
 	# name property inherited
 	dict = bpy.props.CollectionProperty(type=EntityDictPropGroup)
+	# editor_color, editor_mins and editor_maxs parsed from dict, see parse_editor_values
+	color = bpy.props.FloatVectorProperty(size=3, default=(0, 0, 1)) # default to blue
+	mins = bpy.props.FloatVectorProperty(size=3)
+	maxs = bpy.props.FloatVectorProperty(size=3)
+	has_bounds = bpy.props.BoolProperty()
+	is_parsed = bpy.props.BoolProperty()
 	
 	def get_dict_value(self, key, key_default=None):
 		kvp = self.dict.get(key)
@@ -600,6 +693,29 @@ class EntityPropGroup(bpy.types.PropertyGroup):
 			return kvp.value
 		return key_default
 		
+	def get_dict_vector(self, key):
+		"""Returns the value of key as 3 floats, or None if missing or not a vector (e.g. "?")"""
+		value = self.get_dict_value(key)
+		if value:
+			try:
+				v = [float(i) for i in value.split()]
+			except ValueError:
+				return None
+			if len(v) == 3:
+				return v
+		return None
+		
+	def parse_editor_values(self):
+		color = self.get_dict_vector("editor_color")
+		self.color = color if color else (0, 0, 1)
+		mins = self.get_dict_vector("editor_mins")
+		maxs = self.get_dict_vector("editor_maxs")
+		self.has_bounds = mins is not None and maxs is not None
+		if self.has_bounds:
+			self.mins = mins
+			self.maxs = maxs
+		self.is_parsed = True
+		
 class ModelDefPropGroup(bpy.types.PropertyGroup):
 	# name property inherited
 	inherit = bpy.props.StringProperty()
@@ -608,71 +724,77 @@ class ModelDefPropGroup(bpy.types.PropertyGroup):
 class ImportEntities(bpy.types.Operator):
 	bl_idname = "scene.import_entities"
 	bl_label = "Import Entities"
+	entity_def_keys = {"inherit", "model"} # stored along with the editor_ keys
 	
-	def parse_def_file(self, scene, filename):
-		lex = lexer.Lexer(filename)
+	def parse_def_file(self, scene, filename, entity_indices):
+		"""entity_indices maps existing entity names to their index in scene.bfg.entities"""
 		num_entities_created = 0
 		num_entities_updated = 0
 		print("Parsing", os.path.basename(filename), "...", end="", flush=True)
-		while True:
-			token = lex.parse_token()
-			if token == None:
-				break
-			if token == "entityDef":
-				name = lex.parse_token()
-				if name in scene.bfg.entities:
-					entity = scene.bfg.entities[name]
-					num_entities_updated += 1
-				else:
-					entity = scene.bfg.entities.add()
-					entity.name = name
-					num_entities_created += 1
-				lex.expect_token("{")
-				num_required_closing = 1
-				while True:
-					token = lex.parse_token()
-					if token == None:
-						break
-					elif token == "{":
-						num_required_closing += 1
-					elif token == "}":
-						num_required_closing -= 1
-						if num_required_closing == 0:
+		with lexer.Lexer(filename) as lex:
+			parse_token = lex.parse_token
+			while True:
+				token = parse_token()
+				if token == None:
+					break
+				if token == "entityDef":
+					name = parse_token()
+					index = entity_indices.get(name)
+					if index is not None:
+						entity = scene.bfg.entities[index]
+						num_entities_updated += 1
+					else:
+						entity_indices[name] = len(scene.bfg.entities)
+						entity = scene.bfg.entities.add()
+						entity.name = name
+						num_entities_created += 1
+					lex.expect_token("{")
+					num_required_closing = 1
+					while True:
+						token = parse_token()
+						if token == None:
 							break
-					elif token.startswith("editor_") or token in ["inherit", "model"]: # only store what we care about
-						# parse as key-value pair
-						key = token
-						if key in entity.dict:
-							kvp = entity.dict[key]
-						else:
-							kvp = entity.dict.add()
-							kvp.name = key
-						kvp.value = lex.parse_token()
-			elif token == "model":
-				name = lex.parse_token()
-				model_def = scene.bfg.model_defs.get(name)
-				if not model_def:
-					model_def = scene.bfg.model_defs.add()
-					model_def.name = name
-				lex.expect_token("{")
-				num_required_closing = 1
-				while True:
-					token = lex.parse_token()
-					if token == None:
-						break
-					elif token == "{":
-						num_required_closing += 1
-					elif token == "}":
-						num_required_closing -= 1
-						if num_required_closing == 0:
+						elif token == "{":
+							num_required_closing += 1
+						elif token == "}":
+							num_required_closing -= 1
+							if num_required_closing == 0:
+								break
+						elif token.startswith("editor_") or token in self.entity_def_keys: # only store what we care about
+							# parse as key-value pair
+							key = token
+							if key in entity.dict:
+								kvp = entity.dict[key]
+							else:
+								kvp = entity.dict.add()
+								kvp.name = key
+							kvp.value = parse_token()
+					entity.parse_editor_values()
+				elif token == "model":
+					name = parse_token()
+					model_def = scene.bfg.model_defs.get(name)
+					if not model_def:
+						model_def = scene.bfg.model_defs.add()
+						model_def.name = name
+					lex.expect_token("{")
+					num_required_closing = 1
+					while True:
+						token = parse_token()
+						if token == None:
 							break
-					elif token == "inherit":
-						model_def.inherit = lex.parse_token()
-					elif token == "mesh":
-						model_def.mesh = lex.parse_token()
-			else:
-				name = lex.parse_token() # name, sometimes opening brace
-				lex.skip_bracket_delimiter_section("{", "}", True if name == "{" else False)
+						elif token == "{":
+							num_required_closing += 1
+						elif token == "}":
+							num_required_closing -= 1
+							if num_required_closing == 0:
+								break
+						elif token == "inherit":
+							model_def.inherit = parse_token()
+						elif token == "mesh":
+							model_def.mesh = parse_token()
+				else:
+					name = parse_token() # name, sometimes opening brace
+					lex.skip_bracket_delimiter_section("{", "}", True if name == "{" else False)
 		print(" %d entities" % (num_entities_created + num_entities_updated))
 		return (num_entities_created, num_entities_updated)
 		
@@ -684,12 +806,13 @@ class ImportEntities(bpy.types.Operator):
 		self.num_entities_created = 0
 		self.num_entities_updated = 0
 		start_time = time.time() 
-		fs = FileSystem()
-		files = fs.find_files(os.path.join("def", "*.def"))
+		fs = get_file_system()
+		files = fs.find_files("def", ".def")
+		entity_indices = {entity.name: i for i, entity in enumerate(context.scene.bfg.entities)}
 		wm = context.window_manager
 		wm.progress_begin(0, len(files))
 		for i, f in enumerate(files):
-			result = self.parse_def_file(context.scene, f)
+			result = self.parse_def_file(context.scene, f, entity_indices)
 			wm.progress_update(i)
 			self.num_entities_created += result[0]
 			self.num_entities_updated += result[1]
@@ -715,13 +838,13 @@ def find_model_def_mesh(model):
 def create_object_color_material():
 	name = "_object_color"
 	# create the material if it doesn't exist
-	if name in bpy.data.materials:
-		mat = bpy.data.materials[name]
-	else:
+	mat = bpy.data.materials.get(name)
+	if not mat:
 		mat = bpy.data.materials.new(name)
 	mat.use_fake_user = True
 	mat.use_object_color = True
 	mat.use_shadeless = True
+	return mat
 	
 def create_object_entity_properties(context, entity, is_inherited=False):
 	"""Create entity properties on the active object"""
@@ -764,10 +887,10 @@ class AddEntity(bpy.types.Operator):
 			selected_objects = context.selected_objects
 			set_object_mode_and_clear_selection()
 			entity = context.scene.bfg.entities[ae]
-			entity_mins = entity.get_dict_value("editor_mins", "?")
-			entity_maxs = entity.get_dict_value("editor_maxs", "?")
+			if not entity.is_parsed:
+				entity.parse_editor_values() # entities imported before the parsed values existed
 			model = entity.get_dict_value("model")
-			if (entity_mins == "?" or entity_maxs == "?") and not model:
+			if not entity.has_bounds and not model:
 				# brush entity, create as empty
 				if not (active_object and active_object.bfg.type in ['NONE','BRUSH'] and len(selected_objects) > 0):
 					self.report({'ERROR'}, "Brush entities require a brush to be selected")
@@ -786,7 +909,7 @@ class AddEntity(bpy.types.Operator):
 				if model: # create as mesh
 					model = find_model_def_mesh(model) # handle "model" pointing to a model def, inheritance etc.
 					if model:
-						fs = FileSystem()
+						fs = get_file_system()
 						filename = fs.find_file_path(model)
 						if filename:
 							(obj, error_message) = create_model_object(context, filename, model)
@@ -795,33 +918,36 @@ class AddEntity(bpy.types.Operator):
 						if error_message:
 							self.report({'ERROR'}, error_message)
 				if not obj: # no model or create_model_object error: fallback to primitive
-					if entity_mins == "?" or entity_maxs == "?":
+					if not entity.has_bounds:
 						# need bounds
 						self.report({'ERROR'}, "Entity def %s is missing editor_mins and editor_maxs" % entity.name)
 						return {'CANCELLED'}
 					bpy.ops.mesh.primitive_cube_add()
 					obj = context.active_object
-					entity_color = entity.get_dict_value("editor_color", "0 0 1") # default to blue
-					obj.color = [float(i) for i in entity_color.split()] + [float(0.5)] # "r g b"
+					obj.color = list(entity.color) + [0.5]
 					obj.data.name = ae
-					create_object_color_material()
-					obj.data.materials.append(bpy.data.materials["_object_color"])
+					obj.data.materials.append(create_object_color_material())
 					obj.hide_render = True
 					obj.show_wire = True
 					obj.show_transparent = True
 					
 					# set dimensions
-					mins = Vector([float(i) * _scale_to_blender for i in entity_mins.split()])
-					maxs = Vector([float(i) * _scale_to_blender for i in entity_maxs.split()])
+					mins = Vector(entity.mins) * _scale_to_blender
+					maxs = Vector(entity.maxs) * _scale_to_blender
 					size = maxs + -mins
 					obj.dimensions = size
 					
 					# set origin
+					# offset the vertices directly, origin is in world space so undo the object scale
 					origin = (mins + maxs) / 2.0
-					bpy.ops.object.editmode_toggle()
-					bpy.ops.mesh.select_all(action='SELECT')
-					bpy.ops.transform.translate(value=origin)
-					bpy.ops.object.editmode_toggle()
+					offset = numpy.array([o / s if s != 0 else 0 for o, s in zip(origin, obj.scale)], dtype=numpy.float32)
+					verts = obj.data.vertices
+					co = numpy.empty(len(verts) * 3, dtype=numpy.float32)
+					verts.foreach_get("co", co)
+					co.shape = (-1, 3)
+					co += offset
+					verts.foreach_set("co", co.ravel())
+					obj.data.update()
 				obj.lock_rotation = [True, True, False]
 				obj.lock_scale = [True, True, True]
 				obj.show_axis = True # x will be forward
@@ -1023,12 +1149,14 @@ def light_material_preview_items(self, context):
 	pcoll = preview_collections["light"]
 	if not pcoll.needs_refresh:
 		return pcoll.lights
-	fs = FileSystem()
+	fs = get_file_system()
 	lights.append(("default", "default", "default", 0, 0))
 	i = 1
-	for decl in context.scene.bfg.material_decls:
+	decls = context.scene.bfg.material_decls
+	for decl_index in get_material_decl_index(context.scene)[1]:
+		decl = decls[decl_index]
 		# material name must start with "lights" and have a texture
-		if os.path.dirname(decl.name).startswith("lights") and decl.texture != "":
+		if decl.texture != "":
 			preview = None
 			if decl.texture in pcoll: # workaround blender bug, pcoll.load is supposed to return cached preview if name already exists
 				preview = pcoll[decl.texture]
@@ -1064,7 +1192,7 @@ class AddStaticModel(bpy.types.Operator):
 		# the func_static entity model value looks like this
 		# "models/mapobjects/arcade_machine/arcade_machine.lwo"
 		# so the file path must descend from one of the search paths
-		fs = FileSystem()
+		fs = get_file_system()
 		relative_path = fs.calculate_relative_path(self.properties.filepath)
 		if not relative_path:
 			self.report({'ERROR'}, "File \"%s\" not found. Path must descend from \"%s\"" % (self.properties.filepath, context.scene.bfg.game_path))
@@ -1095,13 +1223,20 @@ def update_room_plane_modifier(obj):
 			mod.material_offset = 1
 			mod.material_offset_rim = 2
 
-def update_room_plane_materials(obj):
-	if bpy.data.materials.find(obj.bfg.floor_material) != -1:
-		obj.material_slots[0].material = bpy.data.materials[obj.bfg.floor_material]
-	if bpy.data.materials.find(obj.bfg.ceiling_material) != -1:
-		obj.material_slots[1].material = bpy.data.materials[obj.bfg.ceiling_material]
-	if bpy.data.materials.find(obj.bfg.wall_material) != -1:
-		obj.material_slots[2].material = bpy.data.materials[obj.bfg.wall_material]
+# materials: anything with a get(name) method, defaults to bpy.data.materials
+# callers updating many rooms can pass a name -> material dict instead
+def update_room_plane_materials(obj, materials=None):
+	if materials == None:
+		materials = bpy.data.materials
+	mat = materials.get(obj.bfg.floor_material)
+	if mat:
+		obj.material_slots[0].material = mat
+	mat = materials.get(obj.bfg.ceiling_material)
+	if mat:
+		obj.material_slots[1].material = mat
+	mat = materials.get(obj.bfg.wall_material)
+	if mat:
+		obj.material_slots[2].material = mat
 
 def update_room(self, context):
 	obj = context.active_object
@@ -1117,15 +1252,16 @@ def flip_mesh_normals(mesh):
 	bm.to_mesh(mesh)
 	bm.free()
 	
-def apply_boolean(dest, src, bool_op, flip_normals=False):
+_bool_group_name = "_bool_temp"
+
+def create_bool_object(src, flip_normals=False):
+	"""Create a temp object holding the worldspace mesh of src, to be used as a boolean operand"""
 	# auto unwrap this 3D room or brush if that's what the user wants
 	if src.bfg.type in ['3D_ROOM', 'BRUSH'] and src.bfg.auto_unwrap:
 		auto_unwrap(src.data, src.location, src.scale)
 		
 	# generate mesh for the source object
 	# transform to worldspace
-	bpy.ops.object.select_all(action='DESELECT')
-	dest.select = True
 	me = src.to_mesh(bpy.context.scene, True, 'PREVIEW')
 	me.transform(src.matrix_world)
 	
@@ -1137,19 +1273,107 @@ def apply_boolean(dest, src, bool_op, flip_normals=False):
 		flip_mesh_normals(me)
 		
 	# bool object - need a temp object to hold the result of to_mesh
+	# linked to a group so any that are left behind (e.g. by an error) can be found without scanning every object
 	ob_bool = bpy.data.objects.new("_bool", me)
+	group = bpy.data.groups.get(_bool_group_name)
+	if not group:
+		group = bpy.data.groups.new(_bool_group_name)
+	group.objects.link(ob_bool)
+	return ob_bool
+	
+def remove_temp_object(obj, scene=None):
+	"""Remove a temp bool object and its mesh. scene is the scene obj is linked to, if any"""
+	if scene:
+		scene.objects.unlink(obj)
+	bpy.data.groups[_bool_group_name].objects.unlink(obj)
+	mesh = obj.data
+	bpy.data.objects.remove(obj)
+	bpy.data.meshes.remove(mesh)
+	
+def is_mesh_manifold(mesh):
+	"""True if every edge of mesh is shared by exactly two faces"""
+	if len(mesh.edges) == 0:
+		return False
+	edge_index = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+	mesh.loops.foreach_get("edge_index", edge_index)
+	return bool((numpy.bincount(edge_index, minlength=len(mesh.edges)) == 2).all())
+	
+def apply_boolean_modifier(dest, ob_bool, bool_op, solver):
+	mod = dest.modifiers.new(name=ob_bool.name, type='BOOLEAN')
+	mod.object = ob_bool
+	mod.operation = bool_op
+	mod.solver = solver
+	bpy.ops.object.modifier_apply(apply_as='DATA', modifier=mod.name)
+	
+def apply_boolean_object(dest, ob_bool, bool_op, allow_bmesh=True):
+	"""Apply a boolean modifier with ob_bool as the operand to dest, which must be the active object
+	
+	allow_bmesh must be False unless both meshes face outward, the bmesh solver ignores face orientation"""
+	bpy.ops.object.select_all(action='DESELECT')
+	dest.select = True
 	
 	# copy materials
-	for mat in src.data.materials:
+	for mat in ob_bool.data.materials:
 		if not mat.name in dest.data.materials:
 			dest.data.materials.append(mat)	
 	
-	# apply the boolean modifier
-	mod = dest.modifiers.new(name=src.name, type='BOOLEAN')
-	mod.object = ob_bool
-	mod.operation = bool_op
-	mod.solver = 'CARVE'
-	bpy.ops.object.modifier_apply(apply_as='DATA', modifier=src.name)
+	# the bmesh solver is much faster, but only reliable when both operands are manifold
+	if allow_bmesh and bpy.context.scene.bfg.boolean_solver == 'AUTO' and is_mesh_manifold(dest.data) and is_mesh_manifold(ob_bool.data):
+		backup = dest.data.copy()
+		apply_boolean_modifier(dest, ob_bool, bool_op, 'BMESH')
+		# two manifold operands must give a manifold result, anything else (including no faces) is a bmesh failure, e.g. with coplanar faces
+		if is_mesh_manifold(dest.data):
+			bpy.data.meshes.remove(backup)
+			return
+		# bmesh failed, restore the mesh and try again with carve
+		failed = dest.data
+		name = failed.name
+		dest.data = backup
+		bpy.data.meshes.remove(failed)
+		backup.name = name
+	apply_boolean_modifier(dest, ob_bool, bool_op, 'CARVE')
+	
+def apply_boolean(dest, src, bool_op, flip_normals=False):
+	ob_bool = create_bool_object(src, flip_normals)
+	try:
+		apply_boolean_object(dest, ob_bool, bool_op)
+	finally:
+		remove_temp_object(ob_bool)
+	
+def union_brushes(scene, brushes):
+	"""Union brushes into a single temp bool object, or None if there are no brushes
+	
+	Brushes are unioned in pairs, then the results in pairs and so on, so each boolean operates on similarly sized meshes instead of an ever growing one.
+	The temp objects are all linked to scene, the returned one must be removed with remove_temp_object(obj, scene)."""
+	operands = []
+	active_object = scene.objects.active
+	try:
+		for brush in brushes:
+			obj = create_bool_object(brush)
+			# modifier_apply works on the active object, so it needs to be in the scene
+			scene.objects.link(obj)
+			obj.layers[scene.active_layer] = True
+			operands.append(obj)
+		while len(operands) > 1:
+			unioned = []
+			for i in range(0, len(operands) - 1, 2):
+				dest = operands[i]
+				scene.objects.active = dest
+				apply_boolean_object(dest, operands[i + 1], 'UNION')
+				unioned.append(dest)
+				remove_temp_object(operands[i + 1], scene)
+				operands[i + 1] = None
+			if len(operands) % 2 == 1:
+				unioned.append(operands[-1])
+			operands = unioned
+	except:
+		for obj in operands:
+			if obj:
+				remove_temp_object(obj, scene)
+		raise
+	finally:
+		scene.objects.active = active_object
+	return operands[0] if len(operands) > 0 else None
 
 def flip_object_normals(obj):
 	bpy.ops.object.select_all(action='DESELECT')
@@ -1165,24 +1389,26 @@ def move_object_to_layer(obj, layer_number):
 	obj.layers = layers
 
 def add_all_materials(obj):
-	i = 0
-	for m in bpy.data.materials:
-		if len(obj.data.materials) > i:
-			has_material = False
-			for mat in obj.data.materials:
-				if mat.name == m.name:
-					has_material = True
-			if not has_material:
+	# count slots per material name, kept up to date as slots are overwritten
+	slot_counts = collections.Counter(mat.name for mat in obj.data.materials if mat)
+	num_slots = len(obj.data.materials)
+	for i, m in enumerate(bpy.data.materials):
+		if i < num_slots:
+			if slot_counts[m.name] == 0:
+				old_mat = obj.data.materials[i]
+				if old_mat:
+					slot_counts[old_mat.name] -= 1
+				slot_counts[m.name] += 1
 				obj.data.materials[i] = m
 		else:
 			obj.data.materials.append(m)
-		i += 1
 		
 def build_map(context, rooms, brushes, map_name):
 	scene = context.scene
 
-	# get all the temp bool objects from the last time this map was built
-	bool_objects = [obj for obj in bpy.data.objects if obj.name.startswith(map_name + "_bool")]
+	# get any temp bool objects left behind the last time a map was built
+	group = bpy.data.groups.get(_bool_group_name)
+	bool_objects = list(group.objects) if group else []
 				
 	# create map object
 	# if a map object already exists, its old mesh is removed
@@ -1230,8 +1456,14 @@ def build_map(context, rooms, brushes, map_name):
 		flip_object_normals(map)
 		
 	# combine brushes
-	for brush in brushes:
-		apply_boolean(map, brush, 'UNION')
+	# the brushes are unioned with each other first, then the result with the map
+	# the map is inside out here (the solid outside the rooms), which only carve handles
+	ob_brushes = union_brushes(scene, brushes)
+	if ob_brushes:
+		try:
+			apply_boolean_object(map, ob_brushes, 'UNION', allow_bmesh=False)
+		finally:
+			remove_temp_object(ob_brushes, scene)
 		
 	link_active_object_to_group("map")
 	move_object_to_layer(map, scene.bfg.map_layer)
@@ -1240,9 +1472,7 @@ def build_map(context, rooms, brushes, map_name):
 	
 	# cleanup temp bool objects
 	for obj in bool_objects:
-		mesh = obj.data
-		bpy.data.objects.remove(obj)
-		bpy.data.meshes.remove(mesh)
+		remove_temp_object(obj, scene if obj.name in scene.objects else None)
 		
 class AddRoom(bpy.types.Operator):
 	bl_idname = "scene.add_room"
@@ -1267,29 +1497,13 @@ class AddRoom(bpy.types.Operator):
 			obj.draw_type = 'WIRE'
 		obj.game.physics_type = 'NO_COLLISION'
 		obj.hide_render = True
+		# one slot each for the ceiling, wall and floor
+		mat = None
 		if len(bpy.data.materials) > 0:
-			mat = get_or_create_active_material(context)
-			if mat:
-				obj.data.materials.append(mat)
-				obj.data.materials.append(mat)
-				obj.data.materials.append(mat)
-				obj.bfg.ceiling_material = mat.name
-				obj.bfg.wall_material = mat.name
-				obj.bfg.floor_material = mat.name
-			else:
-				obj.data.materials.append(bpy.data.materials[0])
-				obj.data.materials.append(bpy.data.materials[0])
-				obj.data.materials.append(bpy.data.materials[0])
-				obj.bfg.ceiling_material = bpy.data.materials[0].name
-				obj.bfg.wall_material = bpy.data.materials[0].name
-				obj.bfg.floor_material = bpy.data.materials[0].name
-		else:
-			bpy.ops.object.material_slot_add()
-			bpy.ops.object.material_slot_add()
-			bpy.ops.object.material_slot_add()
-			obj.bfg.ceiling_material = ""
-			obj.bfg.wall_material = ""
-			obj.bfg.floor_material = ""
+			mat = get_or_create_active_material(context) or bpy.data.materials[0]
+		for i in range(3):
+			obj.data.materials.append(mat) # an empty slot if there are no materials
+		obj.bfg.ceiling_material = obj.bfg.wall_material = obj.bfg.floor_material = mat.name if mat else ""
 		scene.objects.active = obj
 		update_room_plane_modifier(obj)
 		update_room_plane_materials(obj)
@@ -1340,18 +1554,32 @@ class CopyRoom(bpy.types.Operator):
 	def execute(self, context):
 		obj = context.active_object
 		selected_objects = context.selected_objects
+		materials = {m.name: m for m in bpy.data.materials}
+		copy_height = self.copy_op in ['HEIGHT', 'ALL']
+		copy_ceiling = self.copy_op in ['MATERIAL_CEILING', 'MATERIAL_ALL', 'ALL']
+		copy_wall = self.copy_op in ['MATERIAL_WALL', 'MATERIAL_ALL', 'ALL']
+		copy_floor = self.copy_op in ['MATERIAL_FLOOR', 'MATERIAL_ALL', 'ALL']
+		# only write and update what changed, each property write runs the update_room callback
 		for s in selected_objects:
 			if s.bfg.type == '2D_ROOM':
-				if self.copy_op == 'HEIGHT' or self.copy_op == 'ALL':
+				changed_height = False
+				changed_mat = False
+				if copy_height and s.bfg.room_height != obj.bfg.room_height:
 					s.bfg.room_height = obj.bfg.room_height
-				if self.copy_op == 'MATERIAL_CEILING' or self.copy_op == 'MATERIAL_ALL' or self.copy_op == 'ALL':
+					changed_height = True
+				if copy_ceiling and s.bfg.ceiling_material != obj.bfg.ceiling_material:
 					s.bfg.ceiling_material = obj.bfg.ceiling_material
-				if self.copy_op == 'MATERIAL_WALL' or self.copy_op == 'MATERIAL_ALL' or self.copy_op == 'ALL':
+					changed_mat = True
+				if copy_wall and s.bfg.wall_material != obj.bfg.wall_material:
 					s.bfg.wall_material = obj.bfg.wall_material
-				if self.copy_op == 'MATERIAL_FLOOR' or self.copy_op == 'MATERIAL_ALL' or self.copy_op == 'ALL':
+					changed_mat = True
+				if copy_floor and s.bfg.floor_material != obj.bfg.floor_material:
 					s.bfg.floor_material = obj.bfg.floor_material
-				update_room_plane_modifier(s)
-				update_room_plane_materials(s)
+					changed_mat = True
+				if changed_height:
+					update_room_plane_modifier(s)
+				if changed_mat:
+					update_room_plane_materials(s, materials)
 		return {'FINISHED'}
 		
 class ConvertRoom(bpy.types.Operator):
@@ -1418,78 +1646,115 @@ class BuildMap(bpy.types.Operator):
 ## UV UNWRAPPING
 ################################################################################
 
+# (u axis, v axis, u sign, v sign) for each face direction, indexed by dominant normal axis * 2 + 1 if the normal is negative
+_uv_axes = (
+	(1, 2, 1, 1), # x
+	(1, 2, -1, 1), # -x
+	(0, 2, -1, 1), # y
+	(0, 2, 1, 1), # -y
+	(0, 1, 1, 1), # z
+	(0, 1, 1, -1) # -z
+)
+
+def get_material_texture_sizes(mesh):
+	"""Returns the texture size for each material slot of mesh, defaulting to 128x128"""
+	texture_sizes = []
+	for mat in mesh.materials:
+		texture_size = (128, 128)
+		slot = mat.texture_slots[0] if mat else None # texture_slots always has 18 entries, the first may be empty
+		if slot and slot.texture:
+			tex = slot.texture
+			if hasattr(tex, "image") and tex.image: # if the texture type isn't set to "Image or Movie", the image attribute won't exist
+				if tex.image.size[0] > 0 and tex.image.size[1] > 0: # 0x0 if the image file is missing
+					texture_size = tuple(tex.image.size)
+		texture_sizes.append(texture_size)
+	return texture_sizes
+
+def get_face_directions(normals):
+	"""Returns the _uv_axes index for each row of normals: the largest axis, x before y before z if equal"""
+	axis = numpy.argmax(numpy.abs(normals), axis=1)
+	negative = normals[numpy.arange(len(normals)), axis] < 0
+	return axis * 2 + negative
+
+def auto_unwrap_object_mode(mesh, obj_location, obj_scale):
+	"""Same as the edit mode path in auto_unwrap, but all faces at once with foreach_get/foreach_set"""
+	num_verts = len(mesh.vertices)
+	num_loops = len(mesh.loops)
+	num_polys = len(mesh.polygons)
+	co = numpy.empty(num_verts * 3, dtype=numpy.float32)
+	mesh.vertices.foreach_get("co", co)
+	vertex_index = numpy.empty(num_loops, dtype=numpy.int32)
+	mesh.loops.foreach_get("vertex_index", vertex_index)
+	normal = numpy.empty(num_polys * 3, dtype=numpy.float32)
+	mesh.polygons.foreach_get("normal", normal)
+	loop_start = numpy.empty(num_polys, dtype=numpy.int32)
+	mesh.polygons.foreach_get("loop_start", loop_start)
+	loop_total = numpy.empty(num_polys, dtype=numpy.int32)
+	mesh.polygons.foreach_get("loop_total", loop_total)
+	material_index = numpy.empty(num_polys, dtype=numpy.int32)
+	mesh.polygons.foreach_get("material_index", material_index)
+	
+	texture_sizes = get_material_texture_sizes(mesh)
+	texture_sizes.append((128, 128)) # for material indices without a slot
+	texture_sizes = numpy.array(texture_sizes, dtype=numpy.float64)
+	material_index = numpy.clip(material_index, 0, len(texture_sizes) - 1)
+	
+	uv_axes = numpy.array(_uv_axes)[get_face_directions(normal.reshape(-1, 3))]
+	scale = _scale_to_game / texture_sizes[material_index] * (1.0 / bpy.context.scene.bfg.global_uv_scale)
+	
+	# expand per face values to per loop
+	order = numpy.argsort(loop_start)
+	loop_poly = numpy.repeat(order, loop_total[order])
+	uv_axes = uv_axes[loop_poly]
+	scale = scale[loop_poly]
+	
+	# worldspace position of each loop
+	pos = co.reshape(-1, 3)[vertex_index] * numpy.array(obj_scale, dtype=numpy.float64) + numpy.array(obj_location, dtype=numpy.float64)
+	loops = numpy.arange(num_loops)
+	uv = numpy.empty((num_loops, 2), dtype=numpy.float64)
+	uv[:, 0] = pos[loops, uv_axes[:, 0]] * scale[:, 0] * uv_axes[:, 2]
+	uv[:, 1] = pos[loops, uv_axes[:, 1]] * scale[:, 1] * uv_axes[:, 3]
+	
+	# keep pinned UVs
+	if not mesh.uv_layers.active:
+		mesh.uv_textures.new() # currently blender needs both layers, this creates both
+	uv_data = mesh.uv_layers.active.data
+	pin_uv = numpy.empty(num_loops, dtype=bool)
+	uv_data.foreach_get("pin_uv", pin_uv)
+	if pin_uv.any():
+		old_uv = numpy.empty(num_loops * 2, dtype=numpy.float32)
+		uv_data.foreach_get("uv", old_uv)
+		uv[pin_uv] = old_uv.reshape(-1, 2)[pin_uv]
+	uv_data.foreach_set("uv", uv.astype(numpy.float32).ravel())
+	mesh.update()
+
 def auto_unwrap(mesh, obj_location=Vector(), obj_scale=Vector((1, 1, 1))):
-	if bpy.context.mode == 'EDIT_MESH':
-		bm = bmesh.from_edit_mesh(mesh)
-	else:
-		bm = bmesh.new()
-		bm.from_mesh(mesh)
+	if bpy.context.mode != 'EDIT_MESH':
+		auto_unwrap_object_mode(mesh, obj_location, obj_scale)
+		return
+	bm = bmesh.from_edit_mesh(mesh)
 	uv_layer = bm.loops.layers.uv.verify()
 	bm.faces.layers.tex.verify()  # currently blender needs both layers.
-	for f in bm.faces:
-		if bpy.context.mode == 'EDIT_MESH' and not f.select:
-			continue # ignore faces that aren't selected in edit mode
-		texture_size = (128, 128)
-		mat = mesh.materials[f.material_index]
-		if len(mat.texture_slots) > 0:
-			tex = bpy.data.textures[mat.texture_slots[0].name]
-			if hasattr(tex, "image") and tex.image: # if the texture type isn't set to "Image or Movie", the image attribute won't exist
-				texture_size = tex.image.size
-		nX = f.normal.x
-		nY = f.normal.y
-		nZ = f.normal.z
-		if nX < 0:
-			nX = nX * -1
-		if nY < 0:
-			nY = nY * -1
-		if nZ < 0:
-			nZ = nZ * -1
-		face_normal_largest = nX
-		face_direction = 'x'
-		if face_normal_largest < nY:
-			face_normal_largest = nY
-			face_direction = 'y'
-		if face_normal_largest < nZ:
-			face_normal_largest = nZ
-			face_direction = 'z'
-		if face_direction == 'x':
-			if f.normal.x < 0:
-				face_direction = '-x'
-		if face_direction == 'y':
-			if f.normal.y < 0:
-				face_direction = '-y'
-		if face_direction == 'z':
-			if f.normal.z < 0:
-				face_direction = '-z'
-		scale_x = _scale_to_game / texture_size[0] * (1.0 / bpy.context.scene.bfg.global_uv_scale)
-		scale_y = _scale_to_game / texture_size[1] * (1.0 / bpy.context.scene.bfg.global_uv_scale)
+	texture_sizes = get_material_texture_sizes(mesh)
+	faces = [f for f in bm.faces if f.select] # ignore faces that aren't selected in edit mode
+	directions = get_face_directions(numpy.array([f.normal for f in faces], dtype=numpy.float32).reshape(-1, 3))
+	uv_scale = 1.0 / bpy.context.scene.bfg.global_uv_scale
+	for f, direction in zip(faces, directions.tolist()):
+		texture_size = texture_sizes[f.material_index] if f.material_index < len(texture_sizes) else (128, 128)
+		(u_axis, v_axis, u_sign, v_sign) = _uv_axes[direction]
+		# everything but the vertex position is constant for the face
+		scale_u = obj_scale[u_axis]
+		scale_v = obj_scale[v_axis]
+		location_u = obj_location[u_axis]
+		location_v = obj_location[v_axis]
+		scale_x = _scale_to_game / texture_size[0] * uv_scale * u_sign
+		scale_y = _scale_to_game / texture_size[1] * uv_scale * v_sign
 		for l in f.loops:
 			luv = l[uv_layer]
 			if luv.pin_uv is not True:
-				if face_direction == 'x':
-					luv.uv.x = ((l.vert.co.y * obj_scale[1]) + obj_location[1]) * scale_x
-					luv.uv.y = ((l.vert.co.z * obj_scale[2]) + obj_location[2]) * scale_y
-				if face_direction == '-x':
-					luv.uv.x = (((l.vert.co.y * obj_scale[1]) + obj_location[1]) * scale_x) * -1
-					luv.uv.y = ((l.vert.co.z * obj_scale[2]) + obj_location[2]) * scale_y
-				if face_direction == 'y':
-					luv.uv.x = (((l.vert.co.x * obj_scale[0]) + obj_location[0]) * scale_x) * -1
-					luv.uv.y = ((l.vert.co.z * obj_scale[2]) + obj_location[2]) * scale_y
-				if face_direction == '-y':
-					luv.uv.x = ((l.vert.co.x * obj_scale[0]) + obj_location[0]) * scale_x
-					luv.uv.y = ((l.vert.co.z * obj_scale[2]) + obj_location[2]) * scale_y
-				if face_direction == 'z':
-					luv.uv.x = ((l.vert.co.x * obj_scale[0]) + obj_location[0]) * scale_x
-					luv.uv.y = ((l.vert.co.y * obj_scale[1]) + obj_location[1]) * scale_y
-				if face_direction == '-z':
-					luv.uv.x = (((l.vert.co.x * obj_scale[0]) + obj_location[0]) * scale_x) * 1
-					luv.uv.y = (((l.vert.co.y * obj_scale[1]) + obj_location[1]) * scale_y) * -1
-	if bpy.context.mode == 'EDIT_MESH':
-		bmesh.update_edit_mesh(mesh)
-	else:
-		bm.to_mesh(mesh)
-		bm.free()
-		mesh.update()
+				co = l.vert.co
+				luv.uv = (((co[u_axis] * scale_u) + location_u) * scale_x, ((co[v_axis] * scale_v) + location_v) * scale_y)
+	bmesh.update_edit_mesh(mesh, tessface=False, destructive=False) # UVs only, no geometry changes
 
 class AutoUnwrap(bpy.types.Operator):
 	bl_idname = "object.auto_uv_unwrap"
@@ -1522,6 +1787,9 @@ class FitUV(bpy.types.Operator):
 		uv_layer = bm.loops.layers.uv.active
 		if not uv_layer:
 			return {'CANCELLED'}
+		fit_x = self.axis in ['HORIZONTAL', 'BOTH']
+		fit_y = self.axis in ['VERTICAL', 'BOTH']
+		repeat = context.scene.bfg.uv_fit_repeat
 		for f in bm.faces:
 			if not f.select:
 				continue
@@ -1530,24 +1798,24 @@ class FitUV(bpy.types.Operator):
 			max = [None, None]
 			for l in f.loops:
 				uv = l[uv_layer].uv
-				if self.axis in ['HORIZONTAL', 'BOTH']:
+				if fit_x:
 					min[0] = min_nullable(min[0], uv.x)
 					max[0] = max_nullable(max[0], uv.x)
-				if self.axis in ['VERTICAL', 'BOTH']:
+				if fit_y:
 					min[1] = min_nullable(min[1], uv.y)
 					max[1] = max_nullable(max[1], uv.y)
 			# apply fitting
 			for l in f.loops:
 				uv = l[uv_layer].uv
-				if self.axis in ['HORIZONTAL', 'BOTH']:
+				if fit_x:
 					range = max[0] - min[0]
 					if range != 0: # will be 0 if UVs are uninitialized
-						uv.x = uv.x / range * context.scene.bfg.uv_fit_repeat
-				if self.axis in ['VERTICAL', 'BOTH']:
+						uv.x = uv.x / range * repeat
+				if fit_y:
 					range = max[1] - min[1]
 					if range != 0: # will be 0 if UVs are uninitialized
-						uv.y = uv.y / range * context.scene.bfg.uv_fit_repeat
-		bmesh.update_edit_mesh(obj.data)
+						uv.y = uv.y / range * repeat
+		bmesh.update_edit_mesh(obj.data, tessface=False, destructive=False)
 		return {'FINISHED'}
 		
 class FlipUV(bpy.types.Operator):
@@ -1578,24 +1846,29 @@ class NudgeUV(bpy.types.Operator):
 	bl_label = "Nudge UV"
 	bl_options = {'REGISTER','UNDO'}
 	dir = bpy.props.StringProperty(name="Direction", default='LEFT')
+	directions = { 'LEFT': (1, 0), 'RIGHT': (-1, 0), 'UP': (0, -1), 'DOWN': (0, 1) } # UV offset per increment
 	
 	@classmethod
 	def poll(cls, context):
 		return context.mode == 'EDIT_MESH'
 
 	def execute(self, context):
-		prev_area = context.area.type
-		context.area.type = 'IMAGE_EDITOR'
-		bpy.ops.uv.select_all(action='SELECT')
-		if self.dir == 'LEFT':
-			bpy.ops.transform.translate(value=(context.scene.bfg.uv_nudge_increment, 0, 0))
-		elif self.dir == 'RIGHT':
-			bpy.ops.transform.translate(value=(-context.scene.bfg.uv_nudge_increment, 0, 0))
-		elif self.dir == 'UP':
-			bpy.ops.transform.translate(value=(0, -context.scene.bfg.uv_nudge_increment, 0))
-		elif self.dir == 'DOWN':
-			bpy.ops.transform.translate(value=(0, context.scene.bfg.uv_nudge_increment, 0))
-		context.area.type = prev_area
+		obj = context.active_object
+		bm = bmesh.from_edit_mesh(obj.data)
+		uv_layer = bm.loops.layers.uv.active
+		if not uv_layer:
+			return {'CANCELLED'}
+		direction = self.directions.get(self.dir)
+		if not direction:
+			return {'CANCELLED'}
+		increment = context.scene.bfg.uv_nudge_increment
+		offset = Vector((direction[0] * increment, direction[1] * increment))
+		# offset the UVs directly, the selected face UVs are what the image editor would have selected and translated
+		for f in bm.faces:
+			if f.select:
+				for l in f.loops:
+					l[uv_layer].uv += offset
+		bmesh.update_edit_mesh(obj.data, tessface=False, destructive=False)
 		return {'FINISHED'}
 		
 def is_uv_flipped(context):
@@ -1676,6 +1949,7 @@ class CreatePanel(bpy.types.Panel):
 		row = col.row(align=True)
 		row.operator(BuildMap.bl_idname, "Build Map", icon='MOD_BUILD').bool_op = 'UNION'
 		row.prop(context.scene.bfg, "map_layer")
+		col.prop(context.scene.bfg, "boolean_solver")
 		col.operator(AddRoom.bl_idname, "Add 2D Room", icon='SURFACE_NCURVE')
 		col.operator(AddBrush.bl_idname, "Add 3D Room", icon='SNAP_FACE').s_type = '3D_ROOM'
 		col.operator(AddBrush.bl_idname, "Add Brush", icon='SNAP_VOLUME').s_type = 'BRUSH'
@@ -1840,10 +2114,24 @@ class UvPanel(bpy.types.Panel):
 ## PROPERTIES
 ################################################################################
 
+def update_file_system(self, context):
+	_file_systems.clear()
+	
+def get_group_objects(scene, group_names, types):
+	"""Objects in scene of the given bfg types in the named groups. Cheaper than scanning the scene, every room, brush and entity is added to one of these groups"""
+	# groups are shared by all scenes, only check membership if there's more than one
+	in_scene = set(scene.objects) if len(bpy.data.scenes) > 1 else None
+	for group_name in group_names:
+		group = bpy.data.groups.get(group_name)
+		if group:
+			for obj in group.objects:
+				if obj.bfg.type in types and (in_scene is None or obj in in_scene):
+					yield obj
+
 def update_wireframe_rooms(self, context):
-	for obj in context.scene.objects:
-		if obj.bfg.type in ['2D_ROOM', '3D_ROOM', 'BRUSH']:
-			obj.draw_type = 'WIRE' if context.scene.bfg.wireframe_rooms else 'TEXTURED'
+	draw_type = 'WIRE' if context.scene.bfg.wireframe_rooms else 'TEXTURED'
+	for obj in get_group_objects(context.scene, ["rooms", "brushes"], ['2D_ROOM', '3D_ROOM', 'BRUSH']):
+		obj.draw_type = draw_type
 			
 def get_backface_culling(self):
 	return bpy.context.space_data.show_backface_culling
@@ -1852,23 +2140,23 @@ def set_backface_culling(self, value):
 	bpy.context.space_data.show_backface_culling = value
 			
 def update_show_entity_names(self, context):
-	for obj in context.scene.objects:
-		if obj.bfg.type == 'ENTITY':
-			obj.show_name = context.scene.bfg.show_entity_names
+	show_name = context.scene.bfg.show_entity_names
+	for obj in get_group_objects(context.scene, ["entities"], ['ENTITY']):
+		obj.show_name = show_name
 			
 def update_hide_bad_materials(self, context):
 	preview_collections["material"].force_refresh = True
 	preview_collections["light"].needs_refresh = True
 	
 def update_shadeless_materials(self, context):
+	use_shadeless = context.scene.bfg.shadeless_materials
 	for mat in bpy.data.materials:
-		mat_path = os.path.dirname(mat.name)
-		if mat.name != "_object_color" and mat_path not in _editor_material_paths:
-			mat.use_shadeless = context.scene.bfg.shadeless_materials
+		if mat.name != "_object_color" and mat.use_shadeless != use_shadeless and os.path.dirname(mat.name) not in _editor_material_paths:
+			mat.use_shadeless = use_shadeless
 	
 class BfgScenePropertyGroup(bpy.types.PropertyGroup):
-	game_path = bpy.props.StringProperty(name="RBDOOM-3-BFG Path", description="RBDOOM-3-BFG Path", subtype='DIR_PATH')
-	mod_dir = bpy.props.StringProperty(name="Mod Directory")
+	game_path = bpy.props.StringProperty(name="RBDOOM-3-BFG Path", description="RBDOOM-3-BFG Path", subtype='DIR_PATH', update=update_file_system)
+	mod_dir = bpy.props.StringProperty(name="Mod Directory", update=update_file_system)
 	wireframe_rooms = bpy.props.BoolProperty(name="Wireframe rooms", default=True, update=update_wireframe_rooms)
 	backface_culling = bpy.props.BoolProperty(name="Backface culling", get=get_backface_culling, set=set_backface_culling)
 	show_entity_names = bpy.props.BoolProperty(name="Show entity names", default=False, update=update_show_entity_names)
@@ -1876,6 +2164,10 @@ class BfgScenePropertyGroup(bpy.types.PropertyGroup):
 	shadeless_materials = bpy.props.BoolProperty(name="Fullbright materials", description="Disable lighting on materials", default=True, update=update_shadeless_materials)
 	show_inherited_entity_props = bpy.props.BoolProperty(name="Show inherited properties", description="Show inherited entity properties", default=False)
 	map_layer = bpy.props.IntProperty(name="Layer", default=0, min=0, max=19)
+	boolean_solver = bpy.props.EnumProperty(name="Solver", description="Boolean solver used by Build Map", items=[
+		('AUTO', "Auto", "BMesh for room and brush unions when both meshes are manifold, falling back to Carve if the result isn't"),
+		('CARVE', "Carve", "Always use Carve")
+	], default='AUTO')
 	material_decl_paths = bpy.props.CollectionProperty(type=MaterialDeclPathPropGroup)
 	active_material_decl_path = bpy.props.StringProperty(name="", default="")
 	material_decls = bpy.props.CollectionProperty(type=MaterialDeclPropGroup)
@@ -1920,6 +2212,7 @@ def register():
 	pcoll.materials = ()
 	pcoll.current_decl_path = ""
 	pcoll.force_refresh = False
+	pcoll.decl_index = None
 	preview_collections["material"] = pcoll
 	pcoll = bpy.utils.previews.new()
 	pcoll.lights = ()
@@ -1933,6 +2226,7 @@ def unregister():
 	for pcoll in preview_collections.values():
 		bpy.utils.previews.remove(pcoll)
 	preview_collections.clear()
+	_file_systems.clear()
 
 if __name__ == "__main__":
 	register()
@@ -15,7 +15,7 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.	 If not, see <http://www.gnu.org/licenses/>.
 
-import bpy, bmesh, json, math
+import bpy, bmesh, json, math, numpy, os
 from . import core
 from bpy_extras.io_utils import ExportHelper
 from collections import OrderedDict
@@ -28,173 +28,226 @@ def tuple_to_float_string(t):
 	return "%s %s %s" % (ftos(t[0]), ftos(t[1]), ftos(t[2]))
 	
 def create_primitive(context, obj, obj_transform, index):
-	# need a temp mesh to store the result of to_mesh and a temp object for mesh operator
-	temp_mesh = obj.to_mesh(context.scene, True, 'PREVIEW')
-	temp_mesh.name = "_export_mesh"
-	if obj_transform:
-		temp_mesh.transform(obj_transform)
-	temp_obj = bpy.data.objects.new("_export_obj", temp_mesh)
-	context.scene.objects.link(temp_obj)
-	temp_obj.select = True
-	context.scene.objects.active = temp_obj
-	bpy.ops.object.editmode_toggle()
-	
-	# duplicate verts/0 length edges mess up dmap portal creation
-	bm = bmesh.from_edit_mesh(temp_obj.data)
-	bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=core._scale_to_blender*0.99) # epsilon < 1 game unit
-	bmesh.update_edit_mesh(temp_obj.data)
-	bm.free()
-	
-	bpy.ops.mesh.select_all(action='SELECT')
-	#bpy.ops.mesh.vert_connect_concave() # make faces convex
-	bpy.ops.mesh.quads_convert_to_tris() # triangulate
-	bpy.ops.object.editmode_toggle()
-	obj = temp_obj
-	mesh = temp_mesh
-	mesh.calc_normals_split() # create face normals
+	# need a temp mesh to store the result of to_mesh
+	mesh = obj.to_mesh(context.scene, True, 'PREVIEW')
+	mesh.name = "_export_mesh"
+	try:
+		if obj_transform:
+			mesh.transform(obj_transform)
+		bm = bmesh.new()
+		bm.from_mesh(mesh)
+		# duplicate verts/0 length edges mess up dmap portal creation
+		bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=core._scale_to_blender*0.99) # epsilon < 1 game unit
+		#bmesh.ops.connect_verts_concave(bm, faces=bm.faces) # make faces convex
+		bmesh.ops.triangulate(bm, faces=bm.faces[:]) # beauty quad and ngon methods by default, same as quads_convert_to_tris
+		bm.to_mesh(mesh)
+		bm.free()
+		mesh.calc_normals_split() # create face normals
 
-	# vertex position and normal are decoupled from uvs
-	# need to:
-	# -create new vertices for each vertex/uv combination
-	# -map the old vertex indices to the new ones
-	vert_map = list(range(len(mesh.vertices)))
-	for i in range(0, len(vert_map)):
-		vert_map[i] = list()
-	for p in mesh.polygons:
-		for i in p.loop_indices:
-			loop = mesh.loops[i]
-			vert_map[loop.vertex_index].append([0, loop.index])
-	num_vertices = 0
-	for i, v in enumerate(mesh.vertices):
-		for vm in vert_map[i]:
-			vm[0] = num_vertices
-			num_vertices += 1
-			
-	prim = OrderedDict()
-	prim["primitive"] = index
+		# vertex position and normal are decoupled from uvs
+		# need to:
+		# -create new vertices for each vertex/uv combination
+		# -map the old vertex indices to the new ones
+		num_loops = len(mesh.loops)
+		num_polys = len(mesh.polygons)
+		co = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float32)
+		mesh.vertices.foreach_get("co", co)
+		vertex_index = numpy.empty(num_loops, dtype=numpy.int32)
+		mesh.loops.foreach_get("vertex_index", vertex_index)
+		normal = numpy.empty(num_loops * 3, dtype=numpy.float32)
+		mesh.loops.foreach_get("normal", normal)
+		uv = numpy.empty(num_loops * 2, dtype=numpy.float32)
+		mesh.uv_layers[0].data.foreach_get("uv", uv)
+		loop_start = numpy.empty(num_polys, dtype=numpy.int32)
+		mesh.polygons.foreach_get("loop_start", loop_start)
+		loop_total = numpy.empty(num_polys, dtype=numpy.int32)
+		mesh.polygons.foreach_get("loop_total", loop_total)
+		material_index = numpy.empty(num_polys, dtype=numpy.int32)
+		mesh.polygons.foreach_get("material_index", material_index)
+		
+		# loop indices in polygon order, then grouped by vertex (stable, so polygon order is kept within a vertex)
+		poly_offset = numpy.cumsum(loop_total) - loop_total
+		poly_loops = numpy.arange(num_loops) + numpy.repeat(loop_start - poly_offset, loop_total)
+		new_vert_loops = poly_loops[numpy.argsort(vertex_index[poly_loops], kind='mergesort')]
+		loop_vert_map = numpy.empty(num_loops, dtype=numpy.int64) # new vertex index for each loop index
+		loop_vert_map[new_vert_loops] = numpy.arange(num_loops)
+		
+		prim = OrderedDict()
+		prim["primitive"] = index
 	
-	# vertices	
-	verts = prim["verts"] = []		
-	for i, v in enumerate(mesh.vertices):
-		for vm in vert_map[i]:
-			uv = mesh.uv_layers[0].data[vm[1]].uv
-			loop = mesh.loops[vm[1]]
+		# vertices, converted to float64 first so the values are the same as reading them one at a time
+		xyz = (co.reshape(-1, 3)[vertex_index[new_vert_loops]].astype(numpy.float64) * core._scale_to_game).tolist()
+		st = uv.reshape(-1, 2)[new_vert_loops].astype(numpy.float64)
+		st[:, 1] = 1.0 - st[:, 1]
+		st = st.tolist()
+		normal = normal.reshape(-1, 3)[new_vert_loops].astype(numpy.float64).tolist()
+		verts = prim["verts"] = []
+		for i in range(len(xyz)):
 			vert = OrderedDict()
-			vert["xyz"] = (v.co.x * core._scale_to_game, v.co.y * core._scale_to_game, v.co.z * core._scale_to_game)
-			vert["st"] = (uv.x, 1.0 - uv.y)
-			vert["normal"] = (loop.normal.x, loop.normal.y, loop.normal.z)
+			vert["xyz"] = xyz[i]
+			vert["st"] = st[i]
+			vert["normal"] = normal[i]
 			verts.append(vert)
 	
-	# polygons
-	polygons = prim["polygons"] = []
-	for p in mesh.polygons:
-		poly = OrderedDict()
-		poly["material"] = obj.material_slots[p.material_index].name
-		indices = poly["indices"] = []
-		for i in p.loop_indices:
-			loop = mesh.loops[i]
-			v = mesh.vertices[loop.vertex_index]
-			uv = mesh.uv_layers[0].data[loop.index].uv
-			# find the vert_map nested list element with the matching loop.index
-			vm = next(x for x in vert_map[loop.vertex_index] if x[1] == loop.index)
-			indices.append(vm[0])
-		polygons.append(poly)
+		# polygons
+		loop_vert_map = loop_vert_map.tolist()
+		slot_names = [mat.name if mat else "" for mat in mesh.materials]
+		polygons = prim["polygons"] = []
+		for start, total, mat_index in zip(loop_start.tolist(), loop_total.tolist(), material_index.tolist()):
+			poly = OrderedDict()
+			poly["material"] = slot_names[mat_index]
+			poly["indices"] = loop_vert_map[start:start + total]
+			polygons.append(poly)
 
-	# finished, delete the temp object and mesh
-	bpy.ops.object.delete()
-	bpy.data.meshes.remove(mesh)
+	finally:
+		# finished, delete the temp mesh
+		bpy.data.meshes.remove(mesh)
 	return prim
 	
+class JsonStream:
+	"""Writes the same output as json.dump, but an object member or list item at a time"""
+	def __init__(self, file, indent, level=0, brackets="{}"):
+		self.file, self.indent, self.level, self.brackets = file, indent, level, brackets
+		self.count = 0
+		file.write(brackets[0])
+		
+	def begin_item(self, key):
+		if self.count > 0:
+			self.file.write("," if self.indent else ", ")
+		if self.indent:
+			self.file.write("\n" + self.indent * (self.level + 1))
+		if key is not None:
+			self.file.write(json.dumps(key) + ": ")
+		self.count += 1
+		
+	def write(self, value, key=None):
+		self.begin_item(key)
+		s = json.dumps(value, indent=self.indent)
+		if self.indent:
+			s = s.replace("\n", "\n" + self.indent * (self.level + 1)) # newlines in strings are escaped, so these are all indentation
+		self.file.write(s)
+		
+	def begin(self, brackets, key=None):
+		"""Start a nested object ("{}") or list ("[]"), end must be called on the returned stream"""
+		self.begin_item(key)
+		return JsonStream(self.file, self.indent, self.level + 1, brackets)
+		
+	def end(self):
+		if self.count > 0 and self.indent:
+			self.file.write("\n" + self.indent * self.level)
+		self.file.write(self.brackets[1])
+	
 def export_map(context, filepath, indent):
 	# set object mode and clear selection
 	if context.active_object:
 		bpy.ops.object.mode_set(mode='OBJECT')
 	bpy.ops.object.select_all(action='DESELECT')
 	
-	data = OrderedDict()
-	data["version"] = 3
-	entities = data["entities"] = []
-	entity_index = 0
+	scene_objects = context.scene.objects
+	map_group = bpy.data.groups.get("map")
+	scale = core._scale_to_game
 	
-	# write worldspawn
-	worldspawn = OrderedDict()
-	worldspawn["entity"] = entity_index
-	worldspawn["classname"] = "worldspawn"
-	primitives = worldspawn["primitives"] = []
-	primitive_index = 0
-	# write the "build map" output
-	built_obj = context.scene.objects.get("_worldspawn")
-	if built_obj:
-		primitives.append(create_primitive(context, built_obj, built_obj.matrix_world, primitive_index))
-		primitive_index += 1
-	# write plain mesh objects
-	# except for children of brush entities and objects in the "map" group, those are handled elsewhere
-	for obj in context.scene.objects:
-		if obj.parent and obj.parent.bfg.type == 'BRUSH_ENTITY':
-			continue
-		map_group = bpy.data.groups.get("map")
-		if map_group and obj.name in map_group.objects:
-			continue
-		if obj.bfg.type == 'NONE' and obj.type == 'MESH':
-			primitives.append(create_primitive(context, obj, obj.matrix_world, primitive_index))
-			primitive_index += 1
-	entities.append(worldspawn)
-	entity_index += 1
-	
-	# write the rest of the entities
-	for obj in context.scene.objects:
-		if obj.bfg.type in ['BRUSH_ENTITY', 'ENTITY', 'STATIC_MODEL'] or obj.type == 'LAMP':
-			ent = OrderedDict()
-			ent["entity"] = entity_index
-			ent["classname"] = "light" if obj.type == 'LAMP' else obj.bfg.classname
-			ent["name"] = obj.name
-			ent["origin"] = tuple_to_float_string(obj.location * core._scale_to_game)
-			if obj.bfg.type in ['BRUSH_ENTITY','ENTITY']:
-				if obj.rotation_euler.z != 0.0:
-					ent["angle"] = ftos(math.degrees(obj.rotation_euler.z))
-				for prop in obj.game.properties:
-					if prop.value != "":
-						if prop.name.startswith("inherited_"): # remove the "inherited_" prefix
-							ent[prop.name[len("inherited_"):]] = prop.value
-						elif prop.name.startswith("custom_"): # remove the "custom_" prefix
-							ent[prop.name[len("custom_"):]] = prop.value
-						else:
-							ent[prop.name] = prop.value
-				# brush entity primitives
-				if obj.bfg.type == 'BRUSH_ENTITY' and len(obj.children) > 0: # warn if brush entity has no children?
-					ent["model"] = obj.name
-					primitives = ent["primitives"] = []
-					primitive_index = 0
-					# find the corresponding "build map" output for this brush entity
-					built_obj = context.scene.objects.get("_" + obj.name)
-					if built_obj:
-						# geometry must be exported in object space
-						primitives.append(create_primitive(context, built_obj, Matrix.Translation(-obj.location) * built_obj.matrix_world, primitive_index))
-						primitive_index += 1
-					# handle plain mesh object children
-					for child in obj.children:
-						if child.bfg.type == 'NONE' and obj.type == 'MESH':
-							# geometry must be exported in object space
-							primitives.append(create_primitive(context, child, Matrix.Translation(-obj.location) * child.matrix_world, primitive_index))
-							primitive_index += 1
-			elif obj.bfg.type == 'STATIC_MODEL':
-				ent["model"] = obj.bfg.entity_model.replace("\\", "/")
-				angles = obj.rotation_euler
-				rot = Euler((-angles[0], -angles[1], -angles[2]), 'XYZ').to_matrix()
-				ent["rotation"] = "%s %s %s" % (tuple_to_float_string(rot[0]), tuple_to_float_string(rot[1]), tuple_to_float_string(rot[2]))
-			elif obj.type == 'LAMP':
-				ent["light_center"] = "0 0 0"
-				radius = ftos(obj.data.distance * core._scale_to_game)
-				ent["light_radius"] = "%s %s %s" % (radius, radius, radius)
-				ent["_color"] = tuple_to_float_string(obj.data.color)
-				ent["nospecular"] = "%d" % 0 if obj.data.use_specular else 1
-				ent["nodiffuse"] = "%d" % 0 if obj.data.use_diffuse else 1
-				if obj.bfg.light_material != "default":
-					ent["texture"] = obj.bfg.light_material
-			entities.append(ent)
+	# primitives are written as soon as they are created, instead of keeping the whole map in memory
+	# write to a temp file so a failed export doesn't replace the previous one with a partial file
+	temp_filepath = filepath + ".tmp"
+	try:
+		with open(temp_filepath, 'w') as f:
+			data = JsonStream(f, "\t" if indent else None)
+			data.write(3, "version")
+			entities = data.begin("[]", "entities")
+			entity_index = 0
+		
+			# write worldspawn
+			worldspawn = entities.begin("{}")
+			worldspawn.write(entity_index, "entity")
+			worldspawn.write("worldspawn", "classname")
+			primitives = worldspawn.begin("[]", "primitives")
+			primitive_index = 0
+			# write the "build map" output
+			built_obj = scene_objects.get("_worldspawn")
+			if built_obj:
+				primitives.write(create_primitive(context, built_obj, built_obj.matrix_world, primitive_index))
+				primitive_index += 1
+			# write plain mesh objects
+			# except for children of brush entities and objects in the "map" group, those are handled elsewhere
+			for obj in scene_objects:
+				if obj.parent and obj.parent.bfg.type == 'BRUSH_ENTITY':
+					continue
+				if map_group and obj.name in map_group.objects:
+					continue
+				if obj.bfg.type == 'NONE' and obj.type == 'MESH':
+					primitives.write(create_primitive(context, obj, obj.matrix_world, primitive_index))
+					primitive_index += 1
+			primitives.end()
+			worldspawn.end()
 			entity_index += 1
-	with open(filepath, 'w') as f:
-		json.dump(data, f, indent="\t" if indent else None)
+		
+			# write the rest of the entities
+			for obj in scene_objects:
+				bfg_type = obj.bfg.type
+				if bfg_type in ['BRUSH_ENTITY', 'ENTITY', 'STATIC_MODEL'] or obj.type == 'LAMP':
+					ent = OrderedDict()
+					ent["entity"] = entity_index
+					ent["classname"] = "light" if obj.type == 'LAMP' else obj.bfg.classname
+					ent["name"] = obj.name
+					ent["origin"] = tuple_to_float_string(obj.location * scale)
+					primitive_objects = None # (object, transform) for each brush entity primitive
+					if bfg_type in ['BRUSH_ENTITY','ENTITY']:
+						if obj.rotation_euler.z != 0.0:
+							ent["angle"] = ftos(math.degrees(obj.rotation_euler.z))
+						for prop in obj.game.properties:
+							if prop.value != "":
+								if prop.name.startswith("inherited_"): # remove the "inherited_" prefix
+									ent[prop.name[len("inherited_"):]] = prop.value
+								elif prop.name.startswith("custom_"): # remove the "custom_" prefix
+									ent[prop.name[len("custom_"):]] = prop.value
+								else:
+									ent[prop.name] = prop.value
+						# brush entity primitives
+						if bfg_type == 'BRUSH_ENTITY' and len(obj.children) > 0: # warn if brush entity has no children?
+							ent["model"] = obj.name
+							primitive_objects = []
+							# find the corresponding "build map" output for this brush entity
+							built_obj = scene_objects.get("_" + obj.name)
+							if built_obj:
+								# geometry must be exported in object space
+								primitive_objects.append((built_obj, Matrix.Translation(-obj.location) * built_obj.matrix_world))
+							# handle plain mesh object children
+							for child in obj.children:
+								if child.bfg.type == 'NONE' and obj.type == 'MESH':
+									# geometry must be exported in object space
+									primitive_objects.append((child, Matrix.Translation(-obj.location) * child.matrix_world))
+					elif bfg_type == 'STATIC_MODEL':
+						ent["model"] = obj.bfg.entity_model.replace("\\", "/")
+						angles = obj.rotation_euler
+						rot = Euler((-angles[0], -angles[1], -angles[2]), 'XYZ').to_matrix()
+						ent["rotation"] = "%s %s %s" % (tuple_to_float_string(rot[0]), tuple_to_float_string(rot[1]), tuple_to_float_string(rot[2]))
+					elif obj.type == 'LAMP':
+						ent["light_center"] = "0 0 0"
+						radius = ftos(obj.data.distance * scale)
+						ent["light_radius"] = "%s %s %s" % (radius, radius, radius)
+						ent["_color"] = tuple_to_float_string(obj.data.color)
+						ent["nospecular"] = "%d" % 0 if obj.data.use_specular else 1
+						ent["nodiffuse"] = "%d" % 0 if obj.data.use_diffuse else 1
+						if obj.bfg.light_material != "default":
+							ent["texture"] = obj.bfg.light_material
+					ent_stream = entities.begin("{}")
+					for key, value in ent.items():
+						ent_stream.write(value, key)
+					if primitive_objects is not None:
+						primitives = ent_stream.begin("[]", "primitives")
+						for primitive_index, (prim_obj, prim_transform) in enumerate(primitive_objects):
+							primitives.write(create_primitive(context, prim_obj, prim_transform, primitive_index))
+						primitives.end()
+					ent_stream.end()
+					entity_index += 1
+			entities.end()
+			data.end()
+	except:
+		if os.path.exists(temp_filepath):
+			os.remove(temp_filepath)
+		raise
+	os.replace(temp_filepath, filepath)
 
 class ExportMap(bpy.types.Operator, ExportHelper):
 	bl_idname = "export_scene.rbdoom_map_json"
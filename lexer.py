@@ -15,14 +15,30 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.	 If not, see <http://www.gnu.org/licenses/>.
 
+import mmap, re
+
 class Lexer:
-	valid_token_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_/\\-.&:"
-	valid_single_tokens = "{}[]()+-*/%!=<>,"
+	valid_token_chars = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_/\\-.&:"
 
 	def __init__(self, filename):
 		self.line, self.pos = 1, 0
-		with open(filename) as file:
-			self.data = file.read()
+		# map the file instead of reading it, tokens are decoded as they are returned
+		with open(filename, "rb") as file:
+			try:
+				self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError: # empty files can't be mapped
+				self.data = b""
+				
+	def __enter__(self):
+		return self
+		
+	def __exit__(self, type, value, traceback):
+		self.close()
+		
+	def close(self):
+		if isinstance(self.data, mmap.mmap):
+			self.data.close()
+		self.data = b""
 			
 	def eof(self):
 		return self.pos >= len(self.data)
@@ -36,78 +52,65 @@ class Lexer:
 		self.skip_whitespace()
 		if self.eof():
 			return None
-		start = self.pos
-		while True:
-			if self.eof():
-				break
-			c = self.data[self.pos]
-			nc = self.data[self.pos + 1] if self.pos + 1 < len(self.data) else None
-			if c == "\"":
-				if not start == self.pos:
-					raise Exception("quote in middle of token")
-				self.pos += 1
-				while True:
-					if self.eof():
-						raise Exception("eof in quoted token")
-					c = self.data[self.pos]
-					self.pos += 1
-					if c == "\"":
-						return self.data[start + 1:self.pos - 1]
-			elif (c == "/" and nc == "/") or (c == "/" and nc == "*"):
-				break
-			elif not c in self.valid_token_chars:
-				if c in self.valid_single_tokens:
-					if self.pos == start:
-						# single character token
-						self.pos += 1
-				break
-			self.pos += 1
-		end = self.pos
-		return self.data[start:end]
+		m = _token_re.match(self.data, self.pos)
+		if m:
+			self.pos = m.end()
+			if self.pos < len(self.data) and self.data[self.pos] == _quote:
+				raise Exception("quote in middle of token")
+			return m.group().decode("latin-1")
+		c = self.data[self.pos] # byte value
+		if c == _quote:
+			# jump straight to the closing quote
+			end = self.data.find(b"\"", self.pos + 1)
+			if end == -1:
+				raise Exception("eof in quoted token")
+			token = self.data[self.pos + 1:end]
+			self.line += token.count(b"\n")
+			self.pos = end + 1
+			return token.decode("latin-1")
+		# single character token. unknown characters are returned the same way so the caller can't hang on them
+		self.pos += 1
+		return _byte_chars[c]
 		
 	def skip_bracket_delimiter_section(self, opening, closing, already_open = False):
 		if not already_open:
 			self.expect_token(opening)
+		# the section isn't tokenized, brackets are counted outside of quoted strings and comments
+		opening, closing = opening.encode("latin-1"), closing.encode("latin-1")
 		num_required_closing = 1
-		while True:
-			token = self.parse_token()
-			if token == None:
-				break
-			elif token == opening:
+		start = self.pos
+		self.pos = len(self.data) # if the section is never closed
+		for m in get_bracket_section_re(opening, closing).finditer(self.data, start):
+			token = m.group()
+			if token == opening:
 				num_required_closing += 1
 			elif token == closing:
 				num_required_closing -= 1
 				if num_required_closing == 0:
+					self.pos = m.end()
 					break
+		self.line += self.data[start:self.pos].count(b"\n")
 		
 	def skip_whitespace(self):
-		while True:
-			if self.eof():
-				break
-			c = self.data[self.pos]
-			nc = self.data[self.pos + 1] if self.pos + 1 < len(self.data) else None
-			if c == "\n":
-				self.line += 1
-				self.pos += 1
-			elif ord(c) <= ord(" "):
-				self.pos += 1
-			elif c == "/" and nc == "/":
-				while True:
-					if self.eof() or self.data[self.pos] == "\n":
-						break
-					self.pos += 1
-			elif c == "/" and nc == "*":
-				while True:
-					if self.eof():
-						break
-					c = self.data[self.pos]
-					nc = self.data[self.pos + 1] if self.pos + 1 < len(self.data) else None
-					if c == "*" and nc == "/":
-						self.pos += 2
-						break
-					self.pos += 1
-			else:
-				break
+		# whitespace, line comments and block comments in a single match
+		m = _whitespace_re.match(self.data, self.pos)
+		if m:
+			self.line += m.group().count(b"\n")
+			self.pos = m.end()
+			
+# a "/" ends a token if it starts a comment
+_token_re = re.compile(rb"(?:[" + re.escape(Lexer.valid_token_chars.replace(b"/", b"")) + rb"]|/(?![/*]))+")
+_whitespace_re = re.compile(rb"(?:[\x00- ]+|//[^\n]*|/\*.*?(?:\*/|\Z))+", re.DOTALL)
+_bracket_section_res = {}
+_quote = ord("\"")
+_byte_chars = tuple(chr(i) for i in range(256)) # latin-1 decoded single character tokens, indexed by byte value
+
+# matches quoted strings, comments and the two brackets
+def get_bracket_section_re(opening, closing):
+	key = (opening, closing)
+	if not key in _bracket_section_res:
+		_bracket_section_res[key] = re.compile(rb'"[^"]*"|//[^\n]*|/\*.*?(?:\*/|\Z)|' + re.escape(opening) + rb"|" + re.escape(closing), re.DOTALL)
+	return _bracket_section_res[key]
 				
 if __name__ == "__main__":
 	'''